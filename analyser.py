@@ -15,18 +15,28 @@ from bokeh.resources import INLINE
 from bokeh.palettes import Spectral
 from collections import namedtuple, defaultdict
 from construct import (Struct, CString, Const, Int32ul, Embedded, Float32l, If, Computed, Peek)
-from datetime import datetime
 from json import loads, dumps
 from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO
 from mgz import header, fast, enums, const
 from mgz.header.de import de
 from mgz.util import MgzPrefixed, ZlibCompressed, Version, VersionAdapter, get_version
-from pandas import DataFrame
+from mmap import mmap, ACCESS_READ
+import numpy as np
+from pandas import DataFrame, factorize, read_csv, to_datetime
 from pathlib import Path
 from webbrowser import open as webbrowser_open
 
 # see mgz/enums.py , stone comes before gold, and thou can haveth fishes.
 resource_names = ['wood','food','stone','gold']
+# expense arrays follow the resource_names order, this maps names to indices
+RESOURCE_IDX = {name: index for index, name in enumerate(resource_names)}
+# 'buy wood' .. 'sell gold', indexed by resource id, +4 for the sells
+MARKET_OP_NAMES = tuple(
+        f'{op} {resource}' for op in ('buy','sell') for resource in resource_names
+)
+# resolves recorded action values back to their enum names at export time,
+# a dict probe is noticeably cheaper than the enum .name descriptor
+ACTION_NAME_BY_VAL = {action.value: action.name for action in fast.Action}
 resource_colors = {
         'wood':'brown',
         'food':'red',
@@ -52,6 +62,9 @@ AOE_PLAYER_COLORS = [
     "#05faf9", # Cyan
 ]
 
+# sentinel marking ignored actions in the dense dispatch table
+ACTION_IGNORED = object()
+
 TSV_COLUMN_NAMES = [
         'ts','type','player','id',
         'wood','food','gold','stone',
@@ -59,46 +72,69 @@ TSV_COLUMN_NAMES = [
         'wood_market','food_market','stone_market',
 ]
 
-class Expense:
-    def __init__(self, wood, food, gold, stone):
-        self.wood = wood
-        self.food = food
-        self.gold = gold
-        self.stone = stone
+def cost_table(specs):
+    '''
+    Flattens the per-id cost dicts of a halfon section ("units_buildings" or
+    "techs") into one dense (max_id+1, 4) array following the resource_names
+    order: looking a cost up becomes a contiguous row slice instead of a dict
+    probe, and scaling one by an amount is a single C call.
+    '''
+    table = np.zeros((max(map(int, specs)) + 1, 4))
+    for _id, spec in specs.items():
+        cost = spec['cost']
+        table[int(_id)] = [cost.get(resource, 0) for resource in resource_names]
+    return table
 
-    def __getitem__(self, resource):
-        if type(resource) == int:
-            resource = resource_names[resource]
-        return getattr(self, resource)
-    
-    def __setitem__(self, resource, value):
-        if type(resource) == int:
-            resource = resource_names[resource]
-        setattr(self, resource, value)
 
-    def __str__(self):
-        return 'Expense[{}]'.format(','.join(map(lambda x:str(self[x]), resource_names)))
-        
-def cost_to_expense(cost, amount = 1):
+def market_totals(op_is_buy, base, fee, amount):
     '''
-    Parses a JSON description of a cost from the AOE2 data specification into
-    an expense object.
+    Pure arithmetic core of a (possibly bulk) market operation: returns the
+    total seen price and the new base price. Deliberately free of any
+    attribute or dict access, so it could be JIT-compiled as-is should the
+    market path ever show up in a profile again.
     '''
-    if amount == None:
-        amount = 1
-    return Expense(
-        amount * cost.get('wood',0),
-        amount * cost.get('food',0),
-        amount * cost.get('gold',0),
-        amount * cost.get('stone',0),
-    )
+    if op_is_buy:
+        # step prices base, base+3, ... are all >= 25 already, so neither
+        # the seen price nor the base price can hit the 25 floor here
+        seen_price = (1+fee) * (amount * base + 3 * amount * (amount-1) / 2)
+        return seen_price, base + 3 * amount
+
+    # going down, both floors can kick in: the base price stops at 25, and
+    # the seen price is floored at 25 too, i.e. as soon as the base drops
+    # below 25/(1-fee) every remaining step is seen as a flat 25
+    unclamped = int(min(amount, max(0, (base - 25/(1-fee)) // 3 + 1)))
+    seen_price = (1-fee) * (unclamped * base - 3 * unclamped * (unclamped-1) / 2) \
+               + 25 * (amount - unclamped)
+    return seen_price, max(25, base - 3 * amount)
+
+class ColumnBuffer:
+    '''
+    Growable preallocated numpy column: appends by index and doubles on
+    overflow, like a python list does, but stores unboxed float64s and hands
+    the finished column to pandas without any conversion.
+    '''
+    def __init__(self, capacity = 1024, dtype = np.float64):
+        self.data = np.empty(capacity, dtype = dtype)
+        self.n = 0
+
+    def append(self, value):
+        data = self.data
+        if self.n == len(data):
+            self.data = data = np.resize(data, 2 * len(data))
+        data[self.n] = value
+        self.n += 1
 
+    def values(self):
+        return self.data[:self.n]
+
+    def __len__(self):
+        return self.n
 
-def ts_to_datetime(ts):
-    return datetime.fromtimestamp(ts/1000)
 
 class RecordingParser:
-    ignored_actions = [
+    # a frozenset, so the per-event membership test is a hash lookup instead
+    # of a linear scan over ~30 enum comparisons
+    ignored_actions = frozenset({
         fast.Action.AI_ORDER,
         fast.Action.ATTACK_GROUND,
         fast.Action.BACK_TO_WORK,
@@ -115,7 +151,6 @@ class RecordingParser:
         fast.Action.GATHER_POINT,
         fast.Action.GUARD,
         fast.Action.MOVE,
-        fast.Action.MOVE,
         fast.Action.ORDER,
         fast.Action.PATROL,
         fast.Action.REPAIR,
@@ -128,7 +163,7 @@ class RecordingParser:
         fast.Action.WALL,
         fast.Action.WORK,
         fast.Action.MAKE,
-    ]
+    })
     def __init__(self, args):
         self.args = args
         self.setup_logging()
@@ -137,6 +172,32 @@ class RecordingParser:
         self.players = dict()
         self.teams = defaultdict(list)
 
+        # Dispatch tables: one O(1) hash lookup per operation instead of
+        # walking an if/elif chain for every event in the recording. Keyed by
+        # the raw int values, hashing an int is cheaper than an enum member.
+        self.op_handlers = {
+            fast.Operation.ACTION.value: self.handle_action,
+            fast.Operation.SYNC.value: self.handle_sync,
+        }
+        self.action_handlers = {
+            fast.Action.BUILD: self.handle_build,
+            fast.Action.BUY: self.handle_buy,
+            fast.Action.DE_QUEUE: self.handle_queue,
+            fast.Action.QUEUE: self.handle_queue,
+            fast.Action.CREATE: self.handle_unsupported,
+            fast.Action.TRIBUTE: self.handle_unsupported,
+            fast.Action.RESEARCH: self.handle_research,
+            fast.Action.SELL: self.handle_sell,
+        }
+        # Consolidate the ignored set and the handlers into one dense table
+        # indexed by the raw action value: one list index per event replaces
+        # the set membership test plus the dict lookup
+        self.action_table = [None] * (max(a.value for a in fast.Action) + 1)
+        for action in RecordingParser.ignored_actions:
+            self.action_table[action.value] = ACTION_IGNORED
+        for action, action_handler in self.action_handlers.items():
+            self.action_table[action.value] = action_handler
+
 
 
     def load_aoe2_data(self):
@@ -150,32 +211,42 @@ class RecordingParser:
         assert self.game_edition in ('de','hd','wk')
         path = Path(__file__).parent.joinpath("halfon","data",f"units_buildings_techs.{self.game_edition}.json")
         self.logger.info(f'Loading the aoe2 data from {path}..')
-        return loads(path.read_text())
+        data = loads(path.read_text())
+
+        # Pre-compute the cost of every unit/building/tech once, so that the
+        # per-event hot path does a single indexed row read instead of a
+        # str(id) conversion plus a walk through the JSON cost dict
+        self.unit_cost = cost_table(data['units_buildings'])
+        self.tech_cost = cost_table(data['techs'])
+
+        # Same for the display names. If a better name exists, extract it out.
+        # Yeah that's localised in english in the halfon data file, but heh
+        # just switch files if you need that, but since how everyone plays in
+        # english these days. Well.
+        self.unit_name = {
+            int(_id): (spec.get('localised_name') or spec['name'])
+            for _id, spec in data['units_buildings'].items()
+        }
+        self.tech_name = {
+            int(_id): (spec.get('localised_name') or spec['name'])
+            for _id, spec in data['techs'].items()
+        }
+
+        return data
 
 
     def setup_market(self):
-        self.market_prices = {
-                'wood': 100,
-                'food': 100,
-                'stone': 130,
-        }
-        self.market_fee_per_player = defaultdict(lambda: 0.3)
+        # Base prices in resource_names order, indexed through RESOURCE_IDX so
+        # the whole market path stays integer-indexed (gold is the currency,
+        # its slot is never traded)
+        self.market_prices = np.array([100.0, 100.0, 130.0, 0.0])
+        # 30% for everyone until they research Guilds (15%). Player numbers
+        # are small ints, so a flat array indexed by player beats a dict with
+        # a default factory invoked on every first lookup
+        self.market_fee_per_player = np.full(len(AOE_PLAYER_COLORS), 0.3)
         
 
     def market_op(self, op, resource, amount, player_id):
-        if amount > 1:
-            # Shift-buy (=5 times) produces the same result as 5 clicks)
-            self.logger.debug(f'Bulk ({amount}) market operation by player {player_id}')
-            expense = Expense(0,0,0,0)
-            for i in range(amount):
-                tmp_exp = self.market_op(op, resource, 1, player_id)
-                expense.wood += tmp_exp.wood
-                expense.food += tmp_exp.food
-                expense.gold += tmp_exp.gold
-                expense.stone += tmp_exp.stone
-            # sum the expenses
-            return expense
-
         # https://ageofempires.fandom.com/wiki/Market_(Age_of_Empires_II)
         #
         # The Market prices for each commodity are universal for all players.
@@ -197,47 +268,51 @@ class RecordingParser:
         # civilizations. If buying a resource would cost less than 25 gold, the
         # game will set the buy price to 25 gold. 
 
-        # Convert resource identifiers into strings
-        if type(resource) == int:
+        # Resolve the resource into both its name (market price keys, logs)
+        # and its expense array index, once, instead of re-dispatching on its
+        # type at every access
+        if isinstance(resource, int):
+            resource_idx = resource
             resource = resource_names[resource]
-        
+        else:
+            resource_idx = RESOURCE_IDX[resource]
+
         assert op in ('buy', 'sell')
 
         # default to 0.3 , whenever someone develops "Guilds", it's supposed to
         # become 0.15
         fee = self.market_fee_per_player[player_id]
 
-        if op == 'buy':
-            seen_price = self.market_prices[resource] * (1+fee)
-            self.market_prices[resource] += 3
-        elif op == 'sell':
-            seen_price = self.market_prices[resource] * (1-fee)
-            self.market_prices[resource] -= 3
-
-
-        # Last line of the paragraph above
-        if seen_price < 25:
-            seen_price = 25
-        if self.market_prices[resource] < 25:
-            self.market_prices[resource] = 25
+        # A shift-buy (amount=5) produces the same result as 5 clicks, and the
+        # price moves by 3 per click: the total is an arithmetic progression,
+        # summed in closed form ("Last line of the paragraph above" is the 25
+        # floor, handled in market_totals) instead of recursing `amount` times
+        seen_price, self.market_prices[resource_idx] = market_totals(
+                op == 'buy',
+                self.market_prices[resource_idx],
+                fee,
+                amount,
+        )
 
         # As it turns out, since we're not approximating live resource counts,
         # counting the negative expenses serves no purpose and breaks the
         # assumption that expenses are only positive, etc. This means I'm
         # disabling the negative resource amounts below ( = no resource income
         # when buying, = no gold income when selling)
+        expense = np.zeros(4)
         if op == 'buy':
-            expense = Expense(0,0,seen_price,0)
-            # expense[resource] = -100
+            expense[RESOURCE_IDX['gold']] = seen_price
+            # expense[RESOURCE_IDX[resource]] = -100 * amount
             # We're counting expenses, so paying 50 food for a villager is positive.
             # Which means, receiving 100 food is negative.
         elif op == 'sell':
-            #expense = Expense(0,0,-1 * seen_price,0)
-            expense = Expense(0,0,0,0)
-            expense[resource] = 100
+            #expense[RESOURCE_IDX['gold']] = -1 * seen_price
+            expense[resource_idx] = 100 * amount
             # Same here, it's an expenditure of 100 food, positive.
 
-        self.logger.debug(f'market op, player {player_id:2d} {op:4s} {resource:5s} at {seen_price} : {expense}')
+        if self.debug_enabled:
+            self.logger.debug('market op, player %2d %4s %5s x%s at %s : %s',
+                              player_id, op, resource, amount, seen_price, expense)
 
         return expense
 
@@ -257,6 +332,10 @@ class RecordingParser:
         stream_handler.setFormatter(formatter)
         logger.addHandler(stream_handler)
         self.logger = logger
+        # snapshot the level check: the per-event debug calls can skip the
+        # whole logging machinery (argument packing included) with one
+        # attribute test instead of isEnabledFor on every event
+        self.debug_enabled = logger.isEnabledFor(DEBUG)
 
     def parse(self, filename, accept_cache = False):
         '''
@@ -266,9 +345,11 @@ class RecordingParser:
         '''
         self.recording_filename = filename
         self.recording_path = Path(filename)
-        file_size = self.recording_path.stat().st_size
         self.current_time = 0
-        self.expenses = []
+        # The expense columns are only allocated once the recording is mapped
+        # (they are sized off the file); they stay None when the TSV cache
+        # supplies the dataframe directly
+        self.expense_cols = None
         self.accept_cache = accept_cache
 
         assert self.recording_path.exists(), '''
@@ -286,166 +367,181 @@ class RecordingParser:
         )
         if self.accept_cache and cached_tsv_path.exists():
             self.logger.info(f'Loading the cached TSV data from {cached_tsv_path}')
-            # Load the TSV, 
-            data = list(
-                    map(
-                        lambda x:x.strip('\n').split('\t'),
-                        cached_tsv_path.read_text().splitlines(),
-                )
-            )
-            # Convert to float except fields 
-            tsv_header = data[0]
-            nofloat_columns = [tsv_header.index(x) for x in ['type','name']]
-            for entry in data[1:]:
-                self.expenses.append([float(entry[i]) if i not in nofloat_columns else entry[i] for i in range(len(entry))])
-
-            self.logger.info(f'Loaded {len(self.expenses)} expenses records from {cached_tsv_path}')
+            # Load the TSV with the pandas C parser, straight into the
+            # dataframe the plotting code consumes, instead of a python loop
+            # converting every field to float one by one
+            self.df = read_csv(cached_tsv_path, sep='\t', dtype={'type': str, 'name': str})
+            self.logger.info(f'Loaded {len(self.df)} expenses records from {cached_tsv_path}')
             return
 
 
         self.logger.info(f'Opening {self.recording_path}')
-        with self.recording_path.open('rb') as descriptor:
+        # Map the recording into memory: the many small reads mgz issues then
+        # walk over pages the OS faults in on demand, with no per-read syscall
+        # or copy (mmap quacks like a file: read/seek/tell)
+        with self.recording_path.open('rb') as recording_file, \
+                mmap(recording_file.fileno(), 0, access=ACCESS_READ) as descriptor:
+            # the mapping knows the file size, no need for a separate stat()
+            file_size = descriptor.size()
+
+            # Expenses are accumulated column-wise, so the dataframe build is
+            # a straight adoption of each column instead of a transpose +
+            # dtype inference over a list of rows. Numeric columns go into
+            # preallocated numpy buffers, only the two text columns stay
+            # python lists. A recording carries very roughly one recordable
+            # event per 64 bytes, use that to size the buffers so most games
+            # never need a regrow.
+            capacity = max(1024, file_size // 64)
+            self.expense_cols = {
+                name: ([] if name == 'name' else ColumnBuffer(capacity))
+                for name in TSV_COLUMN_NAMES
+            }
+            # the type column holds raw fast.Action values, not floats
+            self.expense_cols['type'] = ColumnBuffer(capacity, dtype=np.int32)
+
             # Initiate the mgz parsing by checking out the
             # header
-            self.logger.info('Parsing the header..')
-            header_info = header.parse_stream(descriptor)
+            if getattr(self, 'header_length', None):
+                # get_player_names_from_recording already inflated and parsed
+                # the compressed header and measured it; jump straight to the
+                # body instead of doing all of that a second time
+                self.logger.info('Skipping the already-parsed header..')
+                descriptor.seek(self.header_length)
+            else:
+                self.logger.info('Parsing the header..')
+                header.parse_stream(descriptor)
             self.logger.info('Parsing the "meta" thing..')
             fast.meta(descriptor)
             self.logger.info('Iterating on all operations..')
-            while descriptor.tell() < file_size:
-                op_type, op_data = fast.operation(descriptor)
-                self.route_op(op_type, op_data)
+            # Bind the per-iteration lookups to locals, this loop runs once
+            # per operation in the recording, with the dispatch inlined to
+            # skip a call frame per operation
+            operation = fast.operation
+            op_handlers = self.op_handlers
+            tell = descriptor.tell
+            while tell() < file_size:
+                op_type, op_data = operation(descriptor)
+                handler = op_handlers.get(op_type.value)
+                if handler is not None:
+                    handler(op_data)
+                # CHAT, START, SAVE, VIEWLOCK : we don't care about that.
 
         
-    def route_op(self, op_type, op_data):
-        if op_type == fast.Operation.ACTION:
-            self.handle_action(op_data)
-        elif op_type == fast.Operation.SYNC:
-            ms_elapsed, _dropped = op_data
-            self.current_time += ms_elapsed
-            # Drop sync frames
-            pass
-        elif op_type == fast.Operation.VIEWLOCK:
-            pass
-        else:
-            pass
-            # CHAT, START, SAVE, SYNC, VIEWLOCK : we don't care about that.
-            #raise Exception(NotImplemented)
+    def handle_sync(self, op_data):
+        ms_elapsed, _dropped = op_data
+        self.current_time += ms_elapsed
+        # Drop sync frames
 
     def handle_action(self, op_data):
         action_type, data = op_data
-        if action_type == fast.Action.BUILD:
-            _id = data['building_id']
-            spec = self.aoe_data["units_buildings"][str(_id)]
-            expense = cost_to_expense(spec["cost"])
-        elif action_type == fast.Action.BUY:
-            expense = self.market_op(
-                    op = 'buy',
-                    resource = data['resource_id'],
-                    amount = data['amount'],
-                    player_id = data['player_id'],
-            )
-            _id = 0
-            spec = {
-                    'name': f'buy {resource_names[data["resource_id"]]}'
-            }
-            # if data['resource_id'] > 1: # food & wood are OK, is stone number 2 ? buying gold makes no sense
-            #     raise Exception()
-            # answer: it was
-
-        elif action_type == fast.Action.DE_QUEUE:
-            _id = data['unit_id']
-            spec = self.aoe_data["units_buildings"][str(_id)]
-            expense = cost_to_expense(spec["cost"], amount = data.get('amount'))
-        elif action_type == fast.Action.QUEUE:
-            _id = data['unit_id']
-            spec = self.aoe_data["units_buildings"][str(_id)]
-            expense = cost_to_expense(spec["cost"], amount = data.get('amount'))
-        elif action_type == fast.Action.CREATE:
-            raise Exception()
-        elif action_type == fast.Action.TRIBUTE:
-            raise Exception()
-        elif action_type == fast.Action.RESEARCH:
-            _id = data['technology_id']
-            spec = self.aoe_data["techs"][str(_id)]
-            expense = cost_to_expense(spec["cost"])
-
-            # Guilds cause the player marked prices to go from 30% to 15%
-            if _id == 15:
-                self.logger.info(f'Player {data["player_id"]} researched Guilds at {self.current_time}, fee set to 15%')
-                self.market_fee_per_player[data['player_id']] = 0.15
-
-        elif action_type == fast.Action.SELL:
-            expense = self.market_op(
-                    op = 'sell',
-                    resource = data['resource_id'],
-                    amount = data['amount'],
-                    player_id = data['player_id'],
-            )
-            _id = 0
-            spec = {
-                    'name': f'sell {resource_names[data["resource_id"]]}'
-            }
-        elif action_type in RecordingParser.ignored_actions:
+        value = getattr(action_type, 'value', action_type)
+        handler = self.action_table[value] if value < len(self.action_table) else None
+        if handler is ACTION_IGNORED:
             # Some events are just ignored
             return
-        else:
-            self.logger.debug(f'Unhandled action {action_type} at {self.current_time} : {data}')
+        if handler is None:
+            if self.debug_enabled:
+                self.logger.debug('Unhandled action %s at %s : %s',
+                                  action_type, self.current_time, data)
             # raise Exception()
             return
+        _id, name, expense = handler(data)
+
+        self.record(action_type, data['player_id'], _id, expense, name)
+
+    def handle_build(self, data):
+        _id = data['building_id']
+        return _id, self.unit_name[_id], self.unit_cost[_id]
 
-        # If a better name exists, extract it out. Yeah that's localised in
-        # english in the halfon data file, but heh just switch files if you
-        # need that, but since how everyone plays in english these days. Well. 
-        if spec.get('localised_name') not in ['', None]:
-            spec['name'] = spec['localised_name']
+    def handle_queue(self, data):
+        # QUEUE and DE_QUEUE only differ by their wire format
+        _id = data['unit_id']
+        return _id, self.unit_name[_id], self.unit_cost[_id] * (data.get('amount') or 1)
 
-        self.record(action_type, data['player_id'], _id, expense, spec.get('name'))
+    def handle_research(self, data):
+        _id = data['technology_id']
+
+        # Guilds cause the player marked prices to go from 30% to 15%
+        if _id == 15:
+            self.logger.info(f'Player {data["player_id"]} researched Guilds at {self.current_time}, fee set to 15%')
+            self.market_fee_per_player[data['player_id']] = 0.15
+
+        return _id, self.tech_name[_id], self.tech_cost[_id]
+
+    def handle_buy(self, data):
+        expense = self.market_op(
+                op = 'buy',
+                resource = data['resource_id'],
+                amount = data['amount'],
+                player_id = data['player_id'],
+        )
+        # if data['resource_id'] > 1: # food & wood are OK, is stone number 2 ? buying gold makes no sense
+        #     raise Exception()
+        # answer: it was
+        return 0, MARKET_OP_NAMES[data['resource_id']], expense
+
+    def handle_sell(self, data):
+        expense = self.market_op(
+                op = 'sell',
+                resource = data['resource_id'],
+                amount = data['amount'],
+                player_id = data['player_id'],
+        )
+        return 0, MARKET_OP_NAMES[4 + data['resource_id']], expense
+
+    def handle_unsupported(self, data):
+        # CREATE, TRIBUTE : never met those in a recording so far
+        raise Exception()
 
     def record(self, action_type, player_id, obj_id, expense, internal_name):
-        entry = [
-                self.current_time,
-                action_type,
-                player_id,
-                obj_id,
-                expense.wood,
-                expense.food,
-                expense.gold,
-                expense.stone,
-                internal_name,
-                self.market_prices['wood'],
-                self.market_prices['food'],
-                self.market_prices['stone'],
-        ]
-        self.logger.debug(f'Recording {entry}')
-
-        # convert fast.Action.RESEARCH into 'RESEARCH' for export (and not into '101')
-        entry[1] = entry[1].name
-        self.expenses.append(entry)
+        if self.debug_enabled:
+            self.logger.debug('Recording %s player %s id %s (%s) at %s: %s',
+                              action_type, player_id, obj_id, internal_name,
+                              self.current_time, expense)
+
+        cols = self.expense_cols
+        cols['ts'].append(self.current_time)
+        # store the raw action value; it only becomes 'RESEARCH' when the
+        # dataframe is built, in one batched ACTION_NAME_BY_VAL pass
+        cols['type'].append(action_type.value)
+        cols['player'].append(player_id)
+        cols['id'].append(obj_id)
+        cols['wood'].append(expense[RESOURCE_IDX['wood']])
+        cols['food'].append(expense[RESOURCE_IDX['food']])
+        cols['gold'].append(expense[RESOURCE_IDX['gold']])
+        cols['stone'].append(expense[RESOURCE_IDX['stone']])
+        cols['name'].append(internal_name)
+        prices = self.market_prices
+        cols['wood_market'].append(prices[RESOURCE_IDX['wood']])
+        cols['food_market'].append(prices[RESOURCE_IDX['food']])
+        cols['stone_market'].append(prices[RESOURCE_IDX['stone']])
 
     def export(self, dest = None):
+        if self.expense_cols is None and hasattr(self, 'df'):
+            # The data came from the cached TSV in the first place, no point
+            # in rewriting the very same file
+            self.logger.info('Expenses were loaded from the TSV cache, skipping export')
+            return
         if dest == None:
             dest = self.recording_path.parent.joinpath(
                 f'{self.recording_path.stem}.tsv'
             )
         self.logger.info(f'Writing into {dest}')
-        # Nowadays CSV are TSV files, who would have guessed.
-        dest.write_text('\n'.join([
-            '\t'.join(TSV_COLUMN_NAMES),
-            '\n'.join(
-                map(
-                    lambda entry:'\t'.join(map(str, entry)),
-                    self.expenses,
-                )
-            )
-        ]))
+        # Nowadays CSV are TSV files, who would have guessed. The dataframe
+        # adopts the recorded columns without copying, and the pandas C writer
+        # then formats the whole table in one vectorized pass instead of
+        # str()-ing every cell from python.
+        self.ensure_dataframe()
+        self.df.to_csv(dest, sep='\t', index=False, columns=TSV_COLUMN_NAMES)
 
 
     def get_ages_bars(self, player_id):
         for age_name, timestamp in self.players[player_id]['ages'].items():
-            # Add a vertical line at the right millisecond
+            # Add a vertical line at the right millisecond; convert the same
+            # way as the dt column so the span lines up with the plotted data
+            # in any timezone (fromtimestamp would shift it by the UTC offset)
             yield Span(
-                location = ts_to_datetime(timestamp),
+                location = to_datetime(timestamp, unit='ms'),
                 dimension = 'height',
                 line_width = 3,
                 # line_dash = 'dashed',
@@ -458,26 +554,46 @@ class RecordingParser:
 
     def ensure_dataframe(self):
         '''
-        Convert the self.expenses list into a dataframe, storing it in self.df,
-        but only if it wasn't there.
+        Convert the self.expense_cols columns into a dataframe, storing it in
+        self.df, but only if it wasn't there (it may also come straight from
+        the cached TSV). The derived columns are added either way.
         '''
-        if hasattr(self, 'df'):
-            return
-
-        df = DataFrame.from_records(
-                self.expenses,
-                columns = TSV_COLUMN_NAMES,
-        )
-
-        # Calculate the unified spending evaluation
-        df['unified']  = df['food']  * (df['food_market']/100) \
-                       + df['wood']  * (df['wood_market']/100) \
-                       + df['gold'] \
-                       + df['stone'] * (df['stone_market']/100)
-
+        if not hasattr(self, 'df'):
+            self.df = DataFrame({
+                name: (values if isinstance(values, list) else values.values())
+                for name, values in self.expense_cols.items()
+            })
+            # resolve the recorded action values to their enum names in one
+            # pass, so the TSV still reads 'RESEARCH' and not '101'
+            self.df['type'] = [
+                    ACTION_NAME_BY_VAL[value] for value in self.df['type']
+            ]
+            self.logger.info(f'Built a pandas DataFrame:\n{self.df}')
+        df = self.df
 
-        self.logger.info(f'Built a pandas DataFrame:\n{df}')
-        self.df = df
+        if 'unified' not in df.columns:
+            # Calculate the unified spending evaluation: one fused expression
+            # on the raw float arrays instead of a chain of intermediate
+            # Series
+            numeric = ['wood','food','gold','stone',
+                       'wood_market','food_market','stone_market']
+            df[numeric] = df[numeric].astype(np.float64)
+            df['unified'] = (
+                    df[['food','wood','stone']].to_numpy()
+                    * df[['food_market','wood_market','stone_market']].to_numpy()
+            ).sum(axis=1) / 100 + df['gold'].to_numpy()
+
+        if 'dt' not in df.columns:
+            # Convert the timestamps to datetimes once here, every plot reuses
+            # this column
+            df['dt'] = to_datetime(df['ts'], unit='ms')
+
+        if not hasattr(self, 'player_groups'):
+            # Partition the table per player (and per player+event type) in
+            # one hashed pass; the plots used to re-scan the whole dataframe
+            # with a boolean mask for every single figure
+            self.player_groups = dict(iter(df.groupby('player')))
+            self.player_type_groups = dict(iter(df.groupby(['player','type'])))
 
     def extract_age_times(self):
         self.ensure_dataframe()
@@ -501,7 +617,7 @@ class RecordingParser:
 
         pdf = self.get_player_ops(player_id)
 
-        x = list(map(ts_to_datetime, pdf['ts']))
+        x = pdf['dt'].to_numpy()
 
         # create a new plot with a title and axis labels
         p = figure(title=f"{player_name} expenses over time", x_axis_label='time', y_axis_label='amount spent', **plot_props)
@@ -509,10 +625,9 @@ class RecordingParser:
 
         # add a line renderer with legend and line thickness to the plot
         for resource in resource_names:
-            y = list(pdf[resource])
-            # cumulative, instead of flat
-            for i in range(1,len(y)):
-                y[i] += y[i-1]
+            # cumulative, instead of flat, in a single C pass instead of a
+            # python loop over every event
+            y = pdf[resource].cumsum().to_numpy()
             p.line(x, y, legend_label = resource, line_width=2, color=resource_colors[resource])
 
 
@@ -534,11 +649,11 @@ class RecordingParser:
 
     def get_player_ops(self, player_id, CATEGORY = None):
         self.ensure_dataframe()
-        df = self.df
-        pdf = df[df['player'] == player_id]
-        if CATEGORY is not None:
-            pdf = pdf[pdf['type'] == CATEGORY]
-        return pdf
+        # a player without any matching event yields an empty slice, just like
+        # the boolean masks used to
+        if CATEGORY is None:
+            return self.player_groups.get(player_id, self.df.iloc[0:0])
+        return self.player_type_groups.get((player_id, CATEGORY), self.df.iloc[0:0])
 
     def get_plot_objects(self, CATEGORY, title, player_id, plot_props = {}):
         df = self.df
@@ -548,28 +663,23 @@ class RecordingParser:
         self.logger.info(f'{title} for player {player_id}: {player_name}')
         pdf = self.get_player_ops(player_id, CATEGORY)
 
-        x = list(map(ts_to_datetime, pdf['ts']))
+        x = pdf['dt'].to_numpy()
 
         # create a new plot with a title and axis labels
         p = figure(title=f"{player_name} {title} over time", x_axis_label='time', sizing_mode='stretch_both')
         p.xaxis[0].formatter = DatetimeTickFormatter()
 
         # Add a circle for each unit produced
-        ids = list(map(int,pdf['id']))
-        # remap the ids contiguously, using the user creation order
-        all_seen_ids = []
-        for i in ids:
-            if i not in all_seen_ids:
-                all_seen_ids.append(i)
-        y = [all_seen_ids.index(i) for i in ids]
-
-        # Build a dictionnary of names per id, 
-        names_dict = pdf[['id','name']].drop_duplicates().set_index('id').to_dict('index')
-        _tmp = dict()
-        for k in names_dict:
-            # and take care of changing from the AOE ids into the per-player ids
-            _tmp[all_seen_ids.index(k)] = f'{names_dict[k]["name"]}'
-        names_dict = _tmp
+        ids = pdf['id'].astype(int)
+        # remap the ids contiguously, using the user creation order: factorize
+        # hashes the whole column in one pass instead of the quadratic
+        # list.index() dance
+        y, unique_ids = factorize(ids, sort=False)
+
+        # Build a dictionnary of names per (remapped) id, taking care of
+        # changing from the AOE ids into the per-player ids
+        name_by_id = dict(zip(ids, pdf['name']))
+        names_dict = {i: f'{name_by_id[_id]}' for i, _id in enumerate(unique_ids)}
 
         code = f'''
         var labels = {dumps(names_dict)};
@@ -577,7 +687,7 @@ class RecordingParser:
         '''
         p.yaxis.formatter = FuncTickFormatter(code = code)
         # show all lines
-        p.yaxis.ticker = FixedTicker(ticks = sorted(set(y)))
+        p.yaxis.ticker = FixedTicker(ticks = list(range(len(unique_ids))))
 
         p.circle(x, y, legend_label = title, color="gold")
 
@@ -594,12 +704,10 @@ class RecordingParser:
         p = figure(title=f"Merged expenses over time", x_axis_label='time', y_axis_label='amount spent', **plot_props)
         p.xaxis[0].formatter = DatetimeTickFormatter()
         for player_id in sorted(self.players):
-            pdf = xdf[xdf['player'] == player_id]
-            x = list(map(ts_to_datetime, pdf['ts']))
-            y = list(pdf['unified'])
+            pdf = self.get_player_ops(player_id)
+            x = pdf['dt'].to_numpy()
             # cumulative, instead of flat
-            for i in range(1,len(y)):
-                y[i] += y[i-1]
+            y = pdf['unified'].cumsum().to_numpy()
             player_name = self.players[player_id]['name']
             p.line(
                     x,
@@ -624,31 +732,37 @@ class RecordingParser:
         p = figure(title=f"Team expenses over time", x_axis_label='time', y_axis_label='amount spent', **plot_props)
         p.xaxis[0].formatter = DatetimeTickFormatter()
 
-        arrays = []
+        # Map every player onto the series it contributes to: proper teams
+        # share one key, the "unaligned" team 1 players each keep their own
+        # key (negated, to avoid colliding with real team ids)
+        team_key_per_player = {}
+        team_labels = {}
         for team_id, team_members in self.teams.items():
             if team_id == 1:
                 # Unaligned members
                 for team_member in team_members:
                     player_id = team_member.get('player_number')
-                    pdf = xdf[xdf['player'] == player_id]
-                    x = list(map(ts_to_datetime, pdf['ts']))
-                    y = list(pdf['unified'])
-                    # cumulative, instead of flat
-                    for i in range(1,len(y)):
-                        y[i] += y[i-1]
-                    player_name = self.players[player_id]['name']
-                    arrays.append([x,y,f'Unaligned {player_name}'])
+                    team_key_per_player[player_id] = -player_id
+                    team_labels[-player_id] = f'Unaligned {self.players[player_id]["name"]}'
             else:
                 pnames = ','.join(map(lambda x:x.get('name') ,team_members))
-                team_name = f'Team {team_id} ({pnames})'
-                player_ids = set(map(lambda x:x.get('player_number'), team_members))
-                pdf = xdf[xdf['player'].isin(player_ids)]
-                x = list(map(ts_to_datetime, pdf['ts']))
-                y = list(pdf['unified'])
-                # cumulative, instead of flat
-                for i in range(1,len(y)):
-                    y[i] += y[i-1]
-                arrays.append([x,y,team_name])
+                team_labels[team_id] = f'Team {team_id} ({pnames})'
+                for team_member in team_members:
+                    team_key_per_player[team_member.get('player_number')] = team_id
+
+        # One hashed groupby computes every cumulative series at once, rather
+        # than one boolean scan plus accumulation per drawn line
+        team_key = xdf['player'].map(team_key_per_player)
+        team_cum = xdf.groupby(team_key)['unified'].cumsum()
+
+        arrays = []
+        for key, label in team_labels.items():
+            selected = team_key == key
+            arrays.append([
+                xdf['dt'][selected].to_numpy(),
+                team_cum[selected].to_numpy(),
+                label,
+            ])
 
 
         # For each of the teams, add a line
@@ -794,8 +908,11 @@ class RecordingParser:
             "version"/Computed(lambda ctx: get_version(ctx.game_version, ctx.save_version, ctx.log_version))
         )
         
-        with path.open('rb') as h:
-            for player in header.parse_stream(h).de.players:
+        with path.open('rb', buffering=1<<20) as h:
+            parsed = header.parse_stream(h)
+            # Remember where the header ends, so parse() can seek over it
+            self.header_length = parsed.header_length
+            for player in parsed.de.players:
                 # if not player.name.value:
                 #     # Skip players with no name (?)
                 #     self.logger.debug(f'Skipping player {player.player_number} as it has no name ? {player}')